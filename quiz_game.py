@@ -1,164 +1,447 @@
 import streamlit as st
 import pandas as pd
 import requests
-import json
-import base64
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import pybase64
+import orjson
 import html
+import re
 import random
 import time
-import os
+import threading
+import operator
+import logging
+import importlib.util
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 
 # --- GEMINI API / CONFIGURATION ---
 GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:generateContent"
+GEMINI_STREAM_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:streamGenerateContent"
 # FIX: Use a stable getter with a default path, ensuring the key is available.
 # We retrieve the key from the [gemini] section of st.secrets.
 API_KEY = st.secrets.get("gemini", {}).get("api_key", "")
 
 # --- FIREBASE / LEADERBOARD SETUP ---
-try:
+# firebase_admin is only imported inside get_db(): it drags in gRPC/protobuf, which
+# deployments without Firestore credentials never need. find_spec checks without importing.
+FIREBASE_AVAILABLE = importlib.util.find_spec('firebase_admin') is not None
+if not FIREBASE_AVAILABLE and 'firebase_admin_installed' not in st.session_state:
+    st.warning("⚠️ Leaderboard Offline: Python library 'firebase-admin' not found.")
+    st.session_state.firebase_admin_installed = False
+
+
+@st.cache_resource(show_spinner=False)
+def get_db():
+    """Returns the process-wide Firestore client, or None if the leaderboard is unavailable."""
+    # Check if a Firestore service account is available in st.secrets
+    if not FIREBASE_AVAILABLE or 'firestore_creds' not in st.secrets:
+        return None
+
     import firebase_admin
     from firebase_admin import credentials, firestore
-    
-    # Check if a Firestore service account is available in st.secrets
-    if 'firestore_creds' in st.secrets:
+
+    try:
         if not firebase_admin._apps:
             # FIX: Convert Streamlit AttrDict to standard dict for Firebase compatibility
             creds_dict = st.secrets['firestore_creds']
             cred = credentials.Certificate(dict(creds_dict))
             firebase_admin.initialize_app(cred)
-            st.session_state.db = firestore.client()
-        elif 'db' not in st.session_state:
-            st.session_state.db = firestore.client()
-    else:
-        st.session_state.db = None
-except ImportError:
-    st.session_state.db = None
-    if 'firebase_admin_installed' not in st.session_state:
-        st.warning("⚠️ Leaderboard Offline: Python library 'firebase-admin' not found.")
-        st.session_state.firebase_admin_installed = False
+        return firestore.client()
+    except Exception:
+        # Malformed credentials: treat the leaderboard as offline. The None is cached, so a
+        # bad secret costs one failed parse per process instead of one per rerun; the real
+        # error goes to the server log, since the UI only shows the generic offline notice.
+        logging.exception("Firestore initialization failed; the leaderboard stays offline.")
+        return None
 
 
 # --- 1. CONFIGURATION AND API SETUP (OpenTDB) ---
 API_URL = "https://opentdb.com/api.php"
 
-DIFFICULTY_OPTIONS = {
-    "Very Easy (All)": "all",
-    "Easy": "easy",
-    "Medium": "medium",
-    "Hard": "hard",
-}
+# (display name, API value) pairs; the dicts and lookup tables below are derived once at import
+DIFFICULTY_ITEMS = (
+    ("Very Easy (All)", "all"),
+    ("Easy", "easy"),
+    ("Medium", "medium"),
+    ("Hard", "hard"),
+)
 
-CATEGORY_OPTIONS = {
-    "Mix (Any Category)": 0,
-    "General Knowledge": 9,
-    "Books": 10,
-    "Film": 11,
-    "Music": 12,
-    "Science & Nature": 17,
-    "Computers": 18,
-    "Mathematics": 19,
-    "Geography": 22,
-    "History": 23,
-    "Sports": 21,
-}
+CATEGORY_ITEMS = (
+    ("Mix (Any Category)", 0),
+    ("General Knowledge", 9),
+    ("Books", 10),
+    ("Film", 11),
+    ("Music", 12),
+    ("Science & Nature", 17),
+    ("Computers", 18),
+    ("Mathematics", 19),
+    ("Geography", 22),
+    ("History", 23),
+    ("Sports", 21),
+)
+
+# Precomputed once: main() reruns on every interaction and needs these lookups each time
+DIFFICULTY_OPTIONS = dict(DIFFICULTY_ITEMS)
+DIFFICULTY_NAMES = tuple(name for name, _ in DIFFICULTY_ITEMS)
+DIFFICULTY_REV = {value: name for name, value in DIFFICULTY_ITEMS}
+DIFFICULTY_INDEX = {name: i for i, name in enumerate(DIFFICULTY_NAMES)}
+
+CATEGORY_OPTIONS = dict(CATEGORY_ITEMS)
+CATEGORY_NAMES = tuple(name for name, _ in CATEGORY_ITEMS)
+CATEGORY_REV = {value: name for name, value in CATEGORY_ITEMS}
+CATEGORY_INDEX = {name: i for i, name in enumerate(CATEGORY_NAMES)}
+
+# Questions asked in one quiz
+QUESTIONS_PER_QUIZ = 10
+# Questions requested per OpenTDB call (the API maximum); the surplus covers the next quizzes
+POOL_FETCH_SIZE = 50
+
+# Every OpenTDB result must carry these keys; the getter pulls them out in one C call
+_REQUIRED_FIELDS = ('question', 'correct_answer', 'incorrect_answers', 'difficulty', 'category')
+_get_fields = operator.itemgetter(*_REQUIRED_FIELDS)
+
+# Bound once so the decode loop makes a single C call per question to shuffle options
+_sample = random.sample
+
+@st.cache_resource
+def get_http_session():
+    """Returns a pooled HTTP session (OpenTDB and Gemini) shared across reruns so TLS connections are reused."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        # Transient 5xx answers are retried here, without involving the UI. 429 is left out: a sub-second
+        # retry can't clear OpenTDB's 5s limit, and _fetch_raw reports it as rate limited (code 5) instead
+        max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[500, 502, 503, 504])
+    )
+    session.mount("https://", adapter)
+    return session
 
 # --- Function to fetch explanation using Gemini ---
-def fetch_explanation(question, correct_answer):
-    """Fetches a detailed, grounded explanation for a question/answer pair using the Gemini API."""
-    
-    # Check the key here again to prevent the 403 error message
-    if not API_KEY:
-        return "Explanation API Key is missing. Cannot retrieve detailed rationale."
+EXPLANATION_SYSTEM_PROMPT = "You are a world-class trivia expert. Provide clear, concise, and educational explanations based on real-time search results."
 
+def _build_explanation_payload(question, correct_answer):
+    """Builds the grounded Gemini request body asking why `correct_answer` answers `question`."""
     prompt = f"Provide a brief, single-paragraph, factual explanation detailing why '{correct_answer}' is the correct answer for the question: '{question}'."
-    
-    payload = {
+    return {
         "contents": [{"parts": [{"text": prompt}]}],
         "tools": [{"google_search": {} }],
         "systemInstruction": {
-            "parts": [{"text": "You are a world-class trivia expert. Provide clear, concise, and educational explanations based on real-time search results."}]
+            "parts": [{"text": EXPLANATION_SYSTEM_PROMPT}]
         }
     }
-    
-    try:
-        # Using a direct requests call as this is running server-side
-        response = requests.post(
-            f"{GEMINI_API_URL}?key={API_KEY}",
-            json=payload,
-            headers={'Content-Type': 'application/json'}
-        )
-        response.raise_for_status()
-        
-        result = response.json()
-        
-        # Check for specific error message in the response body (e.g., rate limiting)
-        if 'error' in result:
-             return f"Error retrieving explanation: {result['error'].get('message', 'Unknown API Error')}"
 
-        text = result['candidates'][0]['content']['parts'][0]['text']
-        return text.strip()
-        
-    except requests.exceptions.HTTPError as e:
+class GeminiError(Exception):
+    """Raised when a Gemini response body carries an error instead of candidates."""
+
+
+def _parse_explanation(result):
+    """Extracts the explanation text from a Gemini response body, raising GeminiError on API errors."""
+    # Check for specific error message in the response body (e.g., rate limiting)
+    if 'error' in result:
+        raise GeminiError(result['error'].get('message', 'Unknown API Error'))
+
+    text = result['candidates'][0]['content']['parts'][0]['text']
+    return text.strip()
+
+# Prose punctuation only: operator and symbol characters change meaning ("C++" vs "C", "0-1" vs "0+1")
+_PROSE_PUNCT_RE = re.compile(r"[^\w\s+\-*/%=<>#&|^~]+")
+
+def _explanation_cache_key(text):
+    """Normalizes a question so rewordings that differ only in case, prose punctuation or spacing share a cache entry."""
+    return " ".join(_PROSE_PUNCT_RE.sub(" ", text.casefold()).split())
+
+def _answer_cache_key(text):
+    """Normalizes an answer by case and spacing only: answers are short, so any symbol in them may matter."""
+    return " ".join(text.casefold().split())
+
+@st.cache_data(ttl=60 * 60 * 24, max_entries=1024, show_spinner=False)
+def _fetch_explanation_cached(question_key, answer_key, _question, _correct_answer, _streamed=None):
+    """
+    Calls Gemini for one explanation. Failures raise, so only real explanations are cached.
+
+    Only the normalized keys are hashed (st.cache_data skips underscore-prefixed args);
+    the original wording is what gets sent to Gemini. `_streamed` seeds the entry with an
+    explanation stream_explanation already received, without a second call.
+    """
+    if _streamed is not None:
+        return _streamed
+
+    # Server-side call through the pooled session; urllib3 does not retry POSTs by default
+    response = get_http_session().post(
+        f"{GEMINI_API_URL}?key={API_KEY}",
+        json=_build_explanation_payload(_question, _correct_answer),
+        headers={'Content-Type': 'application/json'},
+        timeout=30
+    )
+    response.raise_for_status()
+    return _parse_explanation(response.json())
+
+def _get_explanation(question, correct_answer, streamed=None):
+    """Cached explanation lookup that raises on failure; quiz-time prefetches use it so failed cards can be retried."""
+    return _fetch_explanation_cached(
+        _explanation_cache_key(question),
+        _answer_cache_key(correct_answer),
+        question,
+        correct_answer,
+        _streamed=streamed
+    )
+
+def _explanation_error_message(e):
+    """Turns a failed explanation fetch into the text shown on the review card."""
+    if isinstance(e, GeminiError):
+        return f"Error retrieving explanation: {e}"
+    if isinstance(e, requests.exceptions.HTTPError):
         # Handle the 403 error explicitly
         return f"Error retrieving explanation: HTTP {e.response.status_code}. The API key might be restricted."
-    except Exception as e:
-        return f"Could not retrieve a detailed explanation: {e}"
+    return f"Could not retrieve a detailed explanation: {e}"
+
+def stream_explanation(question, correct_answer):
+    """
+    Yields an explanation chunk by chunk from Gemini's SSE endpoint, so the review card fills in as text arrives.
 
+    Failures (including an empty stream) raise after whatever was already yielded, so the caller only
+    keeps an explanation that finished cleanly.
+    """
+    if not API_KEY:
+        raise GeminiError("the API key is missing. Cannot retrieve detailed rationale.")
+
+    parts = []
+    with get_http_session().post(
+        GEMINI_STREAM_URL,
+        params={"alt": "sse", "key": API_KEY},
+        json=_build_explanation_payload(question, correct_answer),
+        stream=True,
+        timeout=30
+    ) as response:
+        response.raise_for_status()
+        # Raw bytes go straight to orjson, so a text/* response without a charset can't be mis-decoded as Latin-1
+        for line in response.iter_lines():
+            # SSE frames look like "data: {...}"; skip keep-alive blanks and other fields
+            if not line.startswith(b"data:"):
+                continue
+            chunk = orjson.loads(line[len(b"data:"):])
+            if 'error' in chunk:
+                raise GeminiError(chunk['error'].get('message', 'Unknown API Error'))
+            candidate = chunk.get('candidates', [{}])[0]
+            for part in candidate.get('content', {}).get('parts', []):
+                if part.get('text'):
+                    parts.append(part['text'])
+                    yield part['text']
+    if not parts:
+        raise GeminiError("the response had no explanation text.")
+    # Only a fully received explanation goes into the 24h cache that prefetches and repeat quizzes read
+    _get_explanation(question, correct_answer, streamed="".join(parts).strip())
+
+# Meanings of OpenTDB's non-zero response codes, shown to the user when a fetch fails
+OTDB_MESSAGES = {
+    1: "Not enough questions for that combo.",
+    2: "Invalid parameter.",
+    3: "Session token missing.",
+    4: "Token empty — reset needed.",
+    5: "Rate limited by the trivia service; wait a few seconds.",
+}
+# How many times a rate-limited (code 5) request is retried after waiting out the limit
+OTDB_RATE_LIMIT_RETRIES = 2
+# OpenTDB allows one request per IP every 5 seconds
+OTDB_RATE_LIMIT_SECONDS = 5
+
+@st.cache_resource
+def get_otdb_request_clock():
+    """Returns the process-wide record of the last OpenTDB request; the rate limit is per IP, not per session."""
+    return {'last': 0.0, 'lock': threading.Lock()}
+
+def _wait_out_rate_limit(clock):
+    """Sleeps for whatever is left of OpenTDB's rate-limit window, then stamps the clock for the caller's request."""
+    # Held while sleeping so concurrent fetches (a prefetch and a start) queue up instead of colliding
+    with clock['lock']:
+        remaining = OTDB_RATE_LIMIT_SECONDS - (time.monotonic() - clock['last'])
+        if remaining > 0:
+            time.sleep(remaining)
+        clock['last'] = time.monotonic()
+
+class OpenTDBError(Exception):
+    """Raised when OpenTDB answers with a non-zero response_code."""
+    def __init__(self, response_code):
+        super().__init__(f"OpenTDB response code {response_code}")
+        self.response_code = response_code
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _fetch_raw(difficulty, category_id, amount, nonce=0):
+    """Fetches the raw OpenTDB results list. Failures raise, so only good batches are cached.
+
+    `nonce` only takes part in the cache key: bumping it forces a fresh batch for the same settings.
+    """
+    params = {
+        "amount": amount,
+        "category": category_id,
+        "difficulty": difficulty if difficulty != "all" else "",
+        "type": "multiple",
+        "encode": "base64"
+    }
+    
+    # Waits only on a cache miss, i.e. right before a real request; fallback attempts are spaced out here
+    _wait_out_rate_limit(get_otdb_request_clock())
+    response = get_http_session().get(API_URL, params=params, timeout=10)
+    if response.status_code == 429:
+        # The rate limit can also arrive as plain HTTP 429; treat it like response code 5 so it is waited out
+        raise OpenTDBError(5)
+    response.raise_for_status()
+    # orjson parses the raw body bytes directly, skipping requests' encoding detection
+    data = orjson.loads(response.content)
+    
+    if data['response_code'] != 0:
+        raise OpenTDBError(data['response_code'])
+    return data['results']
+
+
+def fetch_questions(difficulty, category_id, amount=10, nonce=0):
+    """
+    Fetches and decodes questions from the OpenTDB API based on user settings.
+
+    Narrow topic/difficulty combos often can't fill `amount` (response code 1), so the
+    request is retried with one quiz's worth, then fewer, then one quiz from any category.
+    Every retry costs a rate-limit window, so the list is kept short.
+    """
+    amounts = (amount, QUESTIONS_PER_QUIZ, max(5, QUESTIONS_PER_QUIZ // 2))
+    attempts = [(category_id, n) for n in dict.fromkeys(n for n in amounts if n <= amount)]
+    if category_id != 0:
+        attempts.append((0, min(amount, QUESTIONS_PER_QUIZ)))
 
-def fetch_questions(difficulty, category_id, amount=10):
-    """Fetches questions from the OpenTDB API based on user settings."""
     with st.spinner(f"Fetching {amount} questions... 🚀"):
-        params = {
-            "amount": amount,
-            "category": category_id,
-            "difficulty": difficulty if difficulty != "all" else "",
-            "type": "multiple",
-            "encode": "base64"
-        }
-        
-        try:
-            response = requests.get(API_URL, params=params, timeout=10)
-            response.raise_for_status()
-            data = response.json()
-            
-            if data['response_code'] == 0:
-                return data['results']
-            else:
-                st.error("API Error: Could not fetch questions. Try 'Mix' category or 'Very Easy' difficulty.")
+        response_code = None
+        for attempt_category, attempt_amount in attempts:
+            try:
+                questions_list = _load_questions_rate_limited(difficulty, attempt_category, attempt_amount, nonce)
+            except OpenTDBError as e:
+                response_code = e.response_code
+                if response_code != 1:
+                    break
+                continue
+            except requests.exceptions.RequestException as e:
+                st.error(f"Network Error: Could not connect to the trivia service. ({e})")
                 return None
-        except requests.exceptions.RequestException as e:
-            st.error(f"Network Error: Could not connect to the trivia service. ({e})")
-            return None
+            except (ValueError, KeyError) as e:
+                # A non-JSON body (orjson.JSONDecodeError), one without response_code/results, or a field that
+                # isn't valid base64/UTF-8 (binascii.Error, UnicodeDecodeError) is the service's fault, not the network's
+                st.error(f"API Error: Unexpected response from the trivia service. ({e})")
+                return None
+
+            # Remembered so start_quiz refills and prefetches from a request known to succeed
+            st.session_state.setdefault('fetch_settings', {})[(difficulty, category_id)] = (attempt_category, attempt_amount)
+            if attempt_category != category_id:
+                st.info("Not enough questions for that topic, so here's a mix from every category.")
+            return questions_list
+
+        message = OTDB_MESSAGES.get(response_code, "Unknown API error.")
+        if response_code == 1:
+            message += " Try 'Mix' category or 'Very Easy' difficulty."
+        st.error(f"API Error: {message}")
+        return None
+
+def _load_questions_rate_limited(difficulty, category_id, amount, nonce):
+    """Fetches and decodes one batch, retrying a few times if it still collides with OpenTDB's rate limit (code 5)."""
+    for _ in range(OTDB_RATE_LIMIT_RETRIES):
+        try:
+            return process_question_data(_fetch_raw(difficulty, category_id, amount, nonce))
+        except OpenTDBError as e:
+            if e.response_code != 5:
+                raise
+            # No sleep here: the retry's _fetch_raw waits out the window the rejected request started
+    return process_question_data(_fetch_raw(difficulty, category_id, amount, nonce))
+
+def _unescape_fast(s):
+    """html.unescape, skipped when the string has no entities (the common case for OpenTDB)."""
+    return html.unescape(s) if '&' in s else s
 
 def process_question_data(results):
-    """Decodes Base64 data and structures questions into a clean DataFrame."""
+    """Decodes Base64 data and structures questions into a list of question dicts."""
+    # Validate up front instead of a blanket try/except, so real decode bugs surface
+    rows = [
+        _get_fields(item) for item in results or ()
+        if isinstance(item, dict) and all(k in item for k in _REQUIRED_FIELDS)
+        and isinstance(item['incorrect_answers'], list)
+    ]
+    if not rows:
+        return []
+
+    # Bind the decoders locally to skip repeated global/attribute lookups in the loop
+    _dec = pybase64.b64decode
+    _un = _unescape_fast
+
+    def _decode_column(column):
+        return [_un(raw.decode('utf-8')) for raw in map(_dec, column)]
+
+    # Decode column by column (one field across every question) rather than item by item
+    questions_b64, answers_b64, incorrect_b64, difficulties_b64, categories_b64 = zip(*rows)
+    questions = _decode_column(questions_b64)
+    answers = _decode_column(answers_b64)
+    incorrect_lists = [_decode_column(incorrect) for incorrect in incorrect_b64]
+    # Difficulty and category are plain ASCII labels from a fixed OpenTDB list: no entities to unescape
+    difficulties = [raw.decode('ascii', 'replace') for raw in map(_dec, difficulties_b64)]
+    categories = [raw.decode('ascii', 'replace') for raw in map(_dec, categories_b64)]
+
     processed_data = []
-    if not results:
-        return pd.DataFrame()
+    for question, correct_answer, incorrect_answers, difficulty, category in zip(
+        questions, answers, incorrect_lists, difficulties, categories
+    ):
+        # Frozen as a tuple: options never change for a question, and the radio re-renders them every rerun
+        all_options = tuple(_sample([correct_answer, *incorrect_answers], len(incorrect_answers) + 1))
 
-    for item in results:
-        try:
-            question = html.unescape(base64.b64decode(item['question']).decode('utf-8'))
-            correct_answer = html.unescape(base64.b64decode(item['correct_answer']).decode('utf-8'))
-            incorrect_answers = [html.unescape(base64.b64decode(ans).decode('utf-8')) for ans in item['incorrect_answers']]
-            
-            all_options = incorrect_answers + [correct_answer]
-            random.shuffle(all_options)
-
-            processed_data.append({
-                "question": question,
-                "options": all_options,
-                "answer": correct_answer,
-                "difficulty": html.unescape(base64.b64decode(item['difficulty']).decode('utf-8')),
-                "category": html.unescape(base64.b64decode(item['category']).decode('utf-8'))
-            })
-        except Exception as e:
-            continue
+        processed_data.append({
+            "question": question,
+            "options": all_options,
+            "answer": correct_answer,
+            "answer_index": all_options.index(correct_answer),
+            "difficulty": difficulty,
+            "category": category
+        })
 
-    return pd.DataFrame(processed_data)
+    return processed_data
 
 # --- 2. Streamlit App Logic ---
 
+# Longest the review page waits on an explanation the quiz already started (matches the Gemini timeout)
+EXPLANATION_WAIT_SECONDS = 30
+
+@st.cache_resource
+def get_prefetch_executor():
+    """Returns the shared thread pool that prefetches explanations while the quiz is being played."""
+    return ThreadPoolExecutor(max_workers=4)
+
+@st.cache_resource
+def get_question_prefetch_executor():
+    """Returns the single worker that prefetches question batches, one at a time, apart from the explanation pool."""
+    return ThreadPoolExecutor(max_workers=1)
+
+def _prefetch_next_batch(difficulty, category_id, amount, nonce):
+    """Warms _fetch_raw's cache with the batch 'Start New Challenge' will ask for next."""
+    try:
+        # _fetch_raw itself waits out what is left of the rate-limit window
+        _fetch_raw(difficulty, category_id, amount, nonce)
+    except Exception:
+        pass # Best effort: a failed prefetch just means the next start fetches normally
+
+def collect_prefetched_explanations():
+    """Moves finished background explanation fetches into answer_history."""
+    futures = st.session_state.get('explanation_futures', {})
+    history = st.session_state.get('answer_history', [])
+    for i, future in list(futures.items()):
+        if future.done():
+            # A failed or cancelled prefetch leaves the explanation unset, so the card can fetch it on demand
+            if (i < len(history) and history[i].get('explanation') is None
+                    and not future.cancelled() and future.exception() is None):
+                history[i]['explanation'] = future.result()
+            del futures[i]
+
+def cancel_explanation_futures():
+    """Cancels this session's queued explanation prefetches so an abandoned quiz stops spending quota."""
+    for future in st.session_state.pop('explanation_futures', {}).values():
+        future.cancel()
+
 def check_answer():
     """
     Checks the user's selected answer from the form, updates score, and moves the index.
@@ -166,15 +449,18 @@ def check_answer():
     if f'radio_{st.session_state.current_index}' not in st.session_state:
         return
 
-    user_choice = st.session_state[f'radio_{st.session_state.current_index}']
-    correct_answer = st.session_state.questions_df.iloc[st.session_state.current_index]['answer']
-    question = st.session_state.questions_df.iloc[st.session_state.current_index]['question'] # Get question for explanation fetch
+    # The radio stores the index of the chosen option, so grading is an int comparison
+    choice_index = st.session_state[f'radio_{st.session_state.current_index}']
+    current_q = st.session_state.questions[st.session_state.current_index]
+    user_choice = current_q['options'][choice_index] if choice_index is not None else None
+    correct_answer = current_q['answer']
+    question = current_q['question'] # Get question for explanation fetch
     
     # Initialize or append to history
     if 'answer_history' not in st.session_state:
         st.session_state.answer_history = []
     
-    is_correct = user_choice == correct_answer
+    is_correct = choice_index == current_q['answer_index']
     
     st.session_state.submitted = True
     
@@ -184,7 +470,7 @@ def check_answer():
         'user_answer': user_choice,
         'correct_answer': correct_answer,
         'is_correct': is_correct,
-        'explanation': None # Will be fetched when review mode is toggled
+        'explanation': None # Prefetched since quiz start, or fetched on demand in review mode
     })
 
     if is_correct:
@@ -196,34 +482,65 @@ def check_answer():
     st.session_state.current_index += 1
 
 def start_quiz():
-    """Fetches questions and starts the quiz based on selected options."""
+    """Starts a quiz from this session's question pool, refilling it from OpenTDB when it runs low."""
     category_id = st.session_state['selected_category']
     difficulty = st.session_state['selected_difficulty']
     
-    results = fetch_questions(difficulty, category_id)
+    # Pools are keyed by settings, so switching topic or difficulty never serves stale questions
+    pool = st.session_state.setdefault('question_pool', {}).setdefault((difficulty, category_id), deque())
+    
+    fetch_settings = st.session_state.setdefault('fetch_settings', {})
+    questions_list = None
     
-    if results:
-        questions_df = process_question_data(results)
-        if not questions_df.empty:
-            st.session_state.questions_df = questions_df
-            st.session_state.num_questions = len(questions_df)
-            st.session_state.score = 0
-            st.session_state.current_index = 0
-            st.session_state.submitted = False
-            st.session_state.quiz_started = True
-            st.session_state.score_submitted = False
-            st.session_state.last_result = None
-            st.session_state.review_mode = False # Disable review mode
-            st.session_state.answer_history = [] # Clear history
-            st.rerun()
+    if len(pool) < QUESTIONS_PER_QUIZ:
+        # Each refill gets a fresh nonce so an already-consumed cached batch is never replayed. _fetch_raw's
+        # cache is process-wide, so the counter starts at a random value: sessions (or a refresh) never collide
+        st.session_state.quiz_nonce = st.session_state.setdefault('quiz_nonce', random.getrandbits(64)) + 1
+        # Start from the amount that last worked for these settings, not one known to come back short
+        _, fetch_amount = fetch_settings.get((difficulty, category_id), (category_id, POOL_FETCH_SIZE))
+        fetched = fetch_questions(difficulty, category_id, fetch_amount, nonce=st.session_state.quiz_nonce)
+        if fetched is None:
+            return
+        if fetch_settings.get((difficulty, category_id), (category_id,))[0] != category_id:
+            # A mixed-category fallback only serves this quiz; pooling it would pass it off as the topic later
+            questions_list = fetched[:QUESTIONS_PER_QUIZ]
         else:
-            st.error("Fetched questions were empty or corrupted. Please try again.")
+            pool.extend(fetched)
+    
+    if questions_list is None:
+        questions_list = [pool.popleft() for _ in range(min(QUESTIONS_PER_QUIZ, len(pool)))]
+    
+    if questions_list:
+        st.session_state.questions = questions_list
+        st.session_state.num_questions = len(questions_list)
+        st.session_state.score = 0
+        st.session_state.current_index = 0
+        st.session_state.submitted = False
+        st.session_state.quiz_started = True
+        st.session_state.score_submitted = False
+        st.session_state.last_result = None
+        st.session_state.review_mode = False # Disable review mode
+        st.session_state.answer_history = [] # Clear history
+        # Questions are answered in order, so question i becomes answer_history[i]: start every
+        # explanation fetch now and they overlap with the whole quiz instead of the review wait
+        executor = get_prefetch_executor()
+        cancel_explanation_futures()
+        st.session_state.explanation_futures = {
+            i: executor.submit(_get_explanation, q['question'], q['answer'])
+            for i, q in enumerate(questions_list)
+        } if API_KEY else {}
+        # The next quiz will need a refill: fetch it during this one so it starts instantly
+        # Skipped when the topic itself came back short: the refill will retry it (and say so) anyway
+        last_category, last_amount = fetch_settings.get((difficulty, category_id), (category_id, POOL_FETCH_SIZE))
+        if len(pool) < QUESTIONS_PER_QUIZ and last_category == category_id:
+            get_question_prefetch_executor().submit(
+                _prefetch_next_batch, difficulty, category_id, last_amount, st.session_state.quiz_nonce + 1
+            )
     else:
-        pass 
+        st.error("Fetched questions were empty or corrupted. Please try again.")
 
 def start_quiz_same_settings():
     """Starts a new quiz using the last used settings."""
-    st.session_state.quiz_started = False 
     start_quiz() 
 
 
@@ -238,55 +555,58 @@ def reset_quiz():
     st.session_state.score_submitted = False
     st.session_state.last_result = None
     st.session_state.review_mode = False
-    if 'questions_df' in st.session_state:
-        del st.session_state['questions_df']
+    if 'questions' in st.session_state:
+        del st.session_state['questions']
     if 'num_questions' in st.session_state:
         del st.session_state['num_questions']
     if 'answer_history' in st.session_state:
         del st.session_state['answer_history']
-    
-    st.rerun()
+    cancel_explanation_futures()
 
-def toggle_review_mode():
-    """Toggles the state to view the quiz review page and fetches explanations if needed."""
-    if not st.session_state.get('review_mode', False):
-        # Only fetch explanations when entering review mode
-        if st.session_state.get('answer_history'):
-            if not API_KEY:
-                st.warning("Cannot fetch explanations: Gemini API Key is missing from the environment.")
-                st.session_state.review_mode = not st.session_state.get('review_mode', False)
-                st.rerun()
-                return
-
-            # Use a progress bar to show fetching status
-            progress_bar = st.progress(0, text="Fetching detailed explanations... Please wait.")
-            
-            history_length = len(st.session_state.answer_history)
-            
-            for i, item in enumerate(st.session_state.answer_history):
-                if item.get('explanation') is None:
-                    # Fetch and store the explanation
-                    explanation = fetch_explanation(item['question'], item['correct_answer'])
-                    st.session_state.answer_history[i]['explanation'] = explanation
-                
-                # Update progress bar
-                progress_bar.progress((i + 1) / history_length)
-                
-            progress_bar.empty() # Clear the progress bar after completion
+def reset_app():
+    """Resets the quiz and drops cached and pooled questions so the next quiz is fetched fresh."""
+    _fetch_raw.clear()
+    if 'question_pool' in st.session_state:
+        del st.session_state['question_pool']
+    if 'fetch_settings' in st.session_state:
+        del st.session_state['fetch_settings']
+    reset_quiz()
 
-        
+def toggle_review_mode():
+    """Toggles the state to view the quiz review page. Explanations are fetched per card, on demand."""
     st.session_state.review_mode = not st.session_state.get('review_mode', False)
-    st.rerun()
 
 # --- 3. FIRESTORE LEADERBOARD FUNCTIONS ---
 
+# Longest the score form waits on the Firestore commit before rerunning without it
+SCORE_WRITE_WAIT_SECONDS = 5
+
+@st.cache_resource
+def get_write_executor():
+    """Returns the shared thread pool that runs Firestore writes off the Streamlit thread."""
+    return ThreadPoolExecutor(max_workers=2)
+
+def _commit_with_retry(batch, attempts=3):
+    """Commits a Firestore write batch, retrying transient failures with exponential backoff."""
+    from google.api_core import exceptions as google_exceptions # Ships with firebase-admin
+
+    for attempt in range(attempts):
+        try:
+            return batch.commit()
+        except (google_exceptions.Aborted, google_exceptions.ServiceUnavailable):
+            if attempt == attempts - 1:
+                raise
+            time.sleep(0.5 * 2 ** attempt)
+
 def save_score_to_db(username, score, num_questions, difficulty, category):
     """Saves the user's quiz score to Firestore."""
-    db = st.session_state.get('db')
+    db = get_db()
     if db is None:
         st.error("Cannot save score: Firestore is not initialized or credentials are missing.")
         return
 
+    from firebase_admin import firestore # Already loaded by get_db()
+
     collection_ref = db.collection(u'quiz_scores')
     percentage = (score / num_questions) * 100 if num_questions > 0 else 0
     
@@ -300,65 +620,139 @@ def save_score_to_db(username, score, num_questions, difficulty, category):
         'timestamp': firestore.SERVER_TIMESTAMP
     }
     
-    try:
-        collection_ref.add(score_data)
-        st.success(f"Score saved! Good job, {username}! Check the Leaderboard.")
-    except Exception as e:
-        st.error(f"Error saving score to Firestore: {e}")
+    # Written as a batch so related docs (e.g. user stats) can join the same atomic commit later;
+    # keep batches to ~40 writes if historical scores are ever bulk-uploaded.
+    batch = db.batch()
+    batch.set(collection_ref.document(), score_data)
+
+    # The commit runs in the background; it is waited on briefly so the caller's rerun usually finds it done
+    # and check_pending_score_write can show the new score. A slow commit just keeps going.
+    future = get_write_executor().submit(_commit_with_retry, batch)
+    st.session_state.pending_score_write = (future, username)
+    with st.spinner("Saving your score..."):
+        wait([future], timeout=SCORE_WRITE_WAIT_SECONDS)
+
+def check_pending_score_write():
+    """Reports the outcome of the background score write, once, on the run after it finishes."""
+    pending = st.session_state.get('pending_score_write')
+    if pending is None:
+        return
+    future, username = pending
+    if not future.done():
+        st.info("Still saving your score... it will show on the leaderboard shortly.")
+        return
+    del st.session_state['pending_score_write']
+    if future.exception() is not None:
+        st.error(f"Error saving score to Firestore: {future.exception()}")
+        # Let the user submit again
+        st.session_state.score_submitted = False
+        return
+    # Cleared on the script thread, before this run draws the leaderboard, so the new score is in it
+    get_leaderboard_data.clear()
+    st.success(f"Score saved! Good job, {username}! Check the Leaderboard.")
 
+@st.cache_data(ttl=30, show_spinner=False)
 def get_leaderboard_data(limit=10):
-    """Fetches the top scores from Firestore."""
-    db = st.session_state.get('db')
+    """
+    Fetches the top scores from Firestore, cached for 30s so reruns don't re-query.
+
+    Query errors raise (and so are not cached) for display_leaderboard to report.
+    """
+    db = get_db()
     if db is None:
-        # Placeholder data for when DB is offline
-        return pd.DataFrame({
-            'User': ['Pr1meGG'], 'Score': ['Leaderboard Offline'], 'Difficulty': ['N/A'], 'Category': ['N/A']
-        })
+        return pd.DataFrame()
+
+    from firebase_admin import firestore # Already loaded by get_db()
 
     collection_ref = db.collection(u'quiz_scores')
     
-    try:
-        query = collection_ref.order_by(u'percentage', direction=firestore.Query.DESCENDING).limit(limit)
-        results = query.stream()
-        
-        leaderboard = []
-        for doc in results:
-            data = doc.to_dict()
-            leaderboard.append({
-                'User': data.get('username', 'Anonymous'),
-                'Score': f"{data.get('score', 0)} / {data.get('total_questions', 0)} ({data.get('percentage', 0):.1f}%)",
-                'Difficulty': data.get('difficulty', 'N/A'),
-                'Category': data.get('category', 'N/A')
-            })
-        
-        return pd.DataFrame(leaderboard)
-        
-    except Exception as e:
-        st.info("No scores found yet! Be the first one to set a record.")
-        return pd.DataFrame()
+    # Ties on percentage are broken by newest first so the top-N is deterministic.
+    # This needs the (percentage DESC, timestamp DESC) composite index declared in firestore.indexes.json.
+    # The projection only pulls the fields shown in the table; ordering on timestamp doesn't require selecting it.
+    query = (
+        collection_ref
+        .select([u'username', u'score', u'total_questions', u'percentage', u'difficulty', u'category'])
+        .order_by(u'percentage', direction=firestore.Query.DESCENDING)
+        .order_by(u'timestamp', direction=firestore.Query.DESCENDING)
+        .limit(limit)
+    )
+    
+    # get() fetches the bounded top-N in one RPC instead of iterating a stream
+    rows = [
+        (
+            data.get('username', 'Anonymous'),
+            data.get('score', 0),
+            data.get('total_questions', 0),
+            data.get('percentage', 0.0),
+            data.get('difficulty', 'N/A'),
+            data.get('category', 'N/A')
+        )
+        for data in (doc.to_dict() for doc in query.get())
+    ]
+    df = pd.DataFrame(rows, columns=['User', 'score', 'total', 'pct', 'Difficulty', 'Category'])
+    
+    # Format the score column with vectorized string ops instead of an f-string per row
+    df['Score'] = (
+        df['score'].astype(str) + ' / ' + df['total'].astype(str)
+        + ' (' + df['pct'].astype(float).round(1).astype(str) + '%)'
+    )
+    return df[['User', 'Score', 'Difficulty', 'Category']]
 
 def display_leaderboard():
     """Fetches and displays the top scores from Firestore."""
     st.subheader("🏆 Global Leaderboard")
     
-    if st.session_state.get('db') is None:
+    # The first get_db() call is what imports firebase_admin and builds the client, so it runs
+    # here under the spinner instead of at startup; the active-quiz screen never triggers it.
+    with st.spinner('Loading top scores...'):
+        db = get_db()
+        try:
+            df_leaderboard = get_leaderboard_data(limit=10) if db is not None else None
+        except Exception as e:
+            # Kept apart from "no scores": a missing composite index raises FailedPrecondition here
+            st.error(f"Could not load the leaderboard: {e}")
+            st.caption("If this mentions an index, deploy `firestore.indexes.json` (see the README).")
+            return
+    
+    if db is None:
         st.markdown(
             """
             _**Leaderboard Offline:** Cannot connect to Firestore. Check your `.streamlit/secrets.toml` file._
             """
         )
-        df_placeholder = get_leaderboard_data(limit=0)
-        st.table(df_placeholder)
+        # Placeholder data for when DB is offline (st.table still builds a DataFrame from it internally)
+        st.table([{'User': 'Pr1meGG', 'Score': 'Leaderboard Offline', 'Difficulty': 'N/A', 'Category': 'N/A'}])
         return
     
-    with st.spinner('Loading top scores...'):
-        df_leaderboard = get_leaderboard_data(limit=10)
-    
     if not df_leaderboard.empty:
         st.dataframe(df_leaderboard, hide_index=True, use_container_width=True)
     else:
         st.info("No scores found yet! Be the first one to set a record.")
 
+def _review_card_html(i, item, explanation):
+    """Builds the styled HTML card for one answered question in the review page."""
+    is_correct = item['is_correct']
+    icon = "✅" if is_correct else "❌"
+    
+    # The explanation section is left out until the user asks for it
+    explanation_html = "" if explanation is None else f"""
+            <div style="margin-top: 15px; padding-top: 10px; border-top: 1px dashed #333;">
+                <p style="font-weight: bold; color: #fff;">💡 Why it's right:</p>
+                <p style="color: #ccc;">{explanation}</p>
+            </div>"""
+    
+    # Use HTML for better styling in the review page
+    # FIX: The crucial change is ensuring the st.markdown call rendering this has unsafe_allow_html=True
+    return f"""
+        <div style="padding: 15px; margin-bottom: 20px; border: 1px solid {'#1f3b4d' if is_correct else '#a83c3c'}; border-left: 5px solid {'#52c2c2' if is_correct else '#e84c4c'}; border-radius: 8px;">
+            <p style="font-weight: bold; font-size: 1.1em; color: #fff;">{icon} Question {i+1}: {item['question']}</p>
+            <p style="margin-bottom: 5px;">**Your Answer:** <span style="color: {'#52c2c2' if is_correct else '#e84c4c'}; font-weight: bold;">{item['user_answer']}</span> ({'Perfect!' if is_correct else 'Incorrect'})</p>
+            <p style="margin-top: 0;">**Correct Answer:** <span style="color: #52c2c2; font-weight: bold;">{item['correct_answer']}</span></p>
+            
+            {explanation_html}
+        </div>
+        """
+
 def display_review_page():
     """Displays the answers and feedback for the completed quiz."""
     st.header("🔍 Quiz Review")
@@ -368,108 +762,172 @@ def display_review_page():
         st.warning("No quiz history found to review.")
         st.button("Return to Results", on_click=toggle_review_mode)
         return
+    
+    collect_prefetched_explanations()
+    prefetching = st.session_state.get('explanation_futures', {})
         
     for i, item in enumerate(st.session_state.answer_history):
-        is_correct = item['is_correct']
-        icon = "✅" if is_correct else "❌"
-        
-        # Use HTML for better styling in the review page
-        # FIX: The crucial change is ensuring this st.markdown call has unsafe_allow_html=True
-        st.markdown(f"""
-            <div style="padding: 15px; margin-bottom: 20px; border: 1px solid {'#1f3b4d' if is_correct else '#a83c3c'}; border-left: 5px solid {'#52c2c2' if is_correct else '#e84c4c'}; border-radius: 8px;">
-                <p style="font-weight: bold; font-size: 1.1em; color: #fff;">{icon} Question {i+1}: {item['question']}</p>
-                <p style="margin-bottom: 5px;">**Your Answer:** <span style="color: {'#52c2c2' if is_correct else '#e84c4c'}; font-weight: bold;">{item['user_answer']}</span> ({'Perfect!' if is_correct else 'Incorrect'})</p>
-                <p style="margin-top: 0;">**Correct Answer:** <span style="color: #52c2c2; font-weight: bold;">{item['correct_answer']}</span></p>
-                
-                <div style="margin-top: 15px; padding-top: 10px; border-top: 1px dashed #333;">
-                    <p style="font-weight: bold; color: #fff;">💡 Why it's right:</p>
-                    <p style="color: #ccc;">{item.get('explanation', 'Fetching explanation...')}</p>
-                </div>
-            </div>
-            """, unsafe_allow_html=True) # <-- THIS IS THE MISSING KEY
+        if item.get('explanation') is not None:
+            st.markdown(_review_card_html(i, item, item['explanation']), unsafe_allow_html=True)
+            continue
+
+        # Not fetched yet: only call Gemini for the cards the user actually asks about,
+        # streaming the text into the card as it arrives and keeping it for later reruns
+        card = st.empty()
+        card.markdown(_review_card_html(i, item, None), unsafe_allow_html=True)
+        if st.button("💡 Why it's right?", key=f'explain_{i}'):
+            future = prefetching.pop(i, None)
+            # A prefetch still queued behind other sessions is dropped; one already running is waited on
+            # (bounded) rather than paying for a second call. If it fails, the card streams instead.
+            if future is not None and not future.cancel():
+                try:
+                    with st.spinner("Fetching explanation..."):
+                        item['explanation'] = future.result(timeout=EXPLANATION_WAIT_SECONDS)
+                    card.markdown(_review_card_html(i, item, item['explanation']), unsafe_allow_html=True)
+                    continue
+                except Exception:
+                    pass # Timed out or failed: stream it below instead
+            explanation = ""
+            card.markdown(_review_card_html(i, item, 'Fetching explanation...'), unsafe_allow_html=True)
+            try:
+                for chunk in stream_explanation(item['question'], item['correct_answer']):
+                    explanation += chunk
+                    card.markdown(_review_card_html(i, item, explanation), unsafe_allow_html=True)
+            except Exception as e:
+                # Shown for this run only: the explanation stays unset, so the button is back to retry
+                card.markdown(_review_card_html(i, item, _explanation_error_message(e)), unsafe_allow_html=True)
+            else:
+                item['explanation'] = explanation.strip()
 
     st.markdown("---")
     st.button("Return to Results", on_click=toggle_review_mode, type="secondary")
 
 
+# --- Page Styling ---
+# Built once at import. It is still emitted on every rerun: Streamlit drops any element a rerun
+# doesn't re-render, so skipping it would strip the styles; an unchanged element is not re-diffed.
+_CSS_BLOCK = """
+<style>
+    /* Custom CSS for a clean, dark, modern look */
+    .css-1d3c0cr { padding-top: 2rem; }
+    .stButton>button { 
+        border-radius: 12px; 
+        transition: all 0.3s;
+    }
+    .stButton>button:hover {
+        transform: scale(1.02);
+    }
+    .stAlert { border-radius: 12px; }
+
+    /* Hiding Streamlit's default hamburger menu and footer/header */
+    #MainMenu {visibility: hidden;}
+    footer {visibility: hidden;}
+    header {visibility: hidden;}
+    .css-1kyxreq { visibility: hidden; } /* Hides the sidebar button container */
+
+    /* Custom aesthetic for the dynamic welcome section */
+    .welcome-box {
+        background-color: #1f3b4d;
+        padding: 25px;
+        border-radius: 15px;
+        margin-top: 20px;
+        box-shadow: 0 4px 10px rgba(0, 0, 0, 0.4);
+        color: #e6f7ff;
+    }
+    .welcome-box h3 {
+        color: #52c2c2;
+        margin-top: 0;
+    }
+</style>
+"""
+
 # --- 4. The Main App Function ---
 
+@st.fragment
+def _render_question(category_name, difficulty_name):
+    """
+    Renders the active question and its answer form. Submitting only reruns this fragment,
+    so the rest of main() is skipped while moving from one question to the next.
+    """
+    # Fragment reruns reuse the original arguments, so the moving parts are read from session state
+    num_questions = st.session_state.num_questions
+    current_index = st.session_state.current_index
+
+    # The last answer ends the quiz, which needs the full app to switch to the results screen
+    if current_index >= num_questions:
+        st.rerun()
+
+    # Display previous result if available
+    if st.session_state.last_result:
+        if st.session_state.last_result == "✅ Correct! Moving to the next question.":
+            st.success(st.session_state.last_result)
+        else:
+            st.error(st.session_state.last_result)
+        st.session_state.last_result = None # Clear feedback after display
+
+    st.markdown(f"**Topic:** `{category_name}` | **Difficulty:** `{difficulty_name}`")
+    
+    st.markdown(f"**Question {current_index + 1} of {num_questions}**")
+    st.progress((current_index + 1) / num_questions)
+    st.markdown("---")
+
+
+    current_q = st.session_state.questions[current_index]
+    
+    question_text = current_q['question']
+    options = current_q['options']
+    
+    st.subheader(f"❓ {question_text}")
+    
+    # FIX: Using st.form's onSubmit to prevent double-click issues
+    with st.form(key=f'question_form_{current_index}', clear_on_submit=False):
+        st.radio(
+            "Select your answer:",
+            range(len(options)),
+            format_func=options.__getitem__,
+            index=None,
+            key=f'radio_{current_index}'
+        )
+        
+        # Submit button calls check_answer; the callback's rerun is scoped to this fragment
+        st.form_submit_button(
+            label='Submit Answer', 
+            type="secondary",
+            on_click=check_answer
+        )
+
+
 def main():
     """The main Streamlit application function."""
     # FIX: Adding safe defaults to st.session_state before reading them
     if 'selected_difficulty' not in st.session_state:
-        st.session_state['selected_difficulty'] = list(DIFFICULTY_OPTIONS.values())[0]
+        st.session_state['selected_difficulty'] = DIFFICULTY_ITEMS[0][1]
     if 'selected_category' not in st.session_state:
-        st.session_state['selected_category'] = list(CATEGORY_OPTIONS.values())[0]
+        st.session_state['selected_category'] = CATEGORY_ITEMS[0][1]
     if 'review_mode' not in st.session_state:
         st.session_state.review_mode = False
 
     st.set_page_config(page_title="The Python Quiz Master", layout="centered", initial_sidebar_state="expanded")
     
-    st.markdown("""
-        <style>
-            /* Custom CSS for a clean, dark, modern look */
-            .css-1d3c0cr { padding-top: 2rem; }
-            .stButton>button { 
-                border-radius: 12px; 
-                transition: all 0.3s;
-            }
-            .stButton>button:hover {
-                transform: scale(1.02);
-            }
-            .stAlert { border-radius: 12px; }
-            
-            /* FIX: Hide the yellow 'Calling st.rerun() within a callback is a no-op.' banner */
-            /* This targets the specific element responsible for the annoying warning */
-            div[data-testid="stStatusWidget"] {
-                display: none !important;
-                height: 0px !important;
-                visibility: hidden !important;
-            }
-            
-            /* Hiding Streamlit's default hamburger menu and footer/header */
-            #MainMenu {visibility: hidden;}
-            footer {visibility: hidden;}
-            header {visibility: hidden;}
-            .css-1kyxreq { visibility: hidden; } /* Hides the sidebar button container */
-            
-            /* Custom aesthetic for the dynamic welcome section */
-            .welcome-box {
-                background-color: #1f3b4d;
-                padding: 25px;
-                border-radius: 15px;
-                margin-top: 20px;
-                box-shadow: 0 4px 10px rgba(0, 0, 0, 0.4);
-                color: #e6f7ff;
-            }
-            .welcome-box h3 {
-                color: #52c2c2;
-                margin-top: 0;
-            }
-        </style>
-        """, unsafe_allow_html=True)
+    st.markdown(_CSS_BLOCK, unsafe_allow_html=True)
     
     st.title("🧠 The Python Quiz Master")
     st.markdown("---")
 
+    check_pending_score_write()
+
     if 'score_submitted' not in st.session_state:
         st.session_state.score_submitted = False
     if 'last_result' not in st.session_state:
         st.session_state.last_result = None
         
-    selected_difficulty_name = next(
-        (k for k, v in DIFFICULTY_OPTIONS.items() if v == st.session_state.get('selected_difficulty')), 
-        list(DIFFICULTY_OPTIONS.keys())[0]
-    )
-    selected_category_name = next(
-        (k for k, v in CATEGORY_OPTIONS.items() if v == st.session_state.get('selected_category')), 
-        list(CATEGORY_OPTIONS.keys())[0]
-    )
+    selected_difficulty_name = DIFFICULTY_REV.get(st.session_state.get('selected_difficulty'), DIFFICULTY_NAMES[0])
+    selected_category_name = CATEGORY_REV.get(st.session_state.get('selected_category'), CATEGORY_NAMES[0])
 
     # --- Sidebar control and visibility ---
     with st.sidebar:
         st.header("App Control")
-        st.button("Reset App", on_click=reset_quiz, use_container_width=True, help="Reset the app to the main settings page.")
+        st.button("Reset App", on_click=reset_app, use_container_width=True, help="Reset the app to the main settings page.")
         st.info("App configuration is on the main dashboard for a cleaner look.")
 
 
@@ -486,8 +944,8 @@ def main():
         with col1:
             selected_difficulty = st.selectbox(
                 "Select Difficulty:",
-                list(DIFFICULTY_OPTIONS.keys()),
-                index=list(DIFFICULTY_OPTIONS.keys()).index(selected_difficulty_name),
+                DIFFICULTY_NAMES,
+                index=DIFFICULTY_INDEX[selected_difficulty_name],
                 key='difficulty_select'
             )
             st.session_state['selected_difficulty'] = DIFFICULTY_OPTIONS[selected_difficulty]
@@ -495,8 +953,8 @@ def main():
         with col2:
             selected_category = st.selectbox(
                 "Select Topic/Subject:",
-                list(CATEGORY_OPTIONS.keys()),
-                index=list(CATEGORY_OPTIONS.keys()).index(selected_category_name),
+                CATEGORY_NAMES,
+                index=CATEGORY_INDEX[selected_category_name],
                 key='category_select'
             )
             st.session_state['selected_category'] = CATEGORY_OPTIONS[selected_category]
@@ -529,49 +987,7 @@ def main():
 
     elif st.session_state.current_index < st.session_state.num_questions:
         # --- Active Quiz Screen ---
-        num_questions = st.session_state.num_questions
-        current_index = st.session_state.current_index
-        score = st.session_state.score
-        questions_df = st.session_state.questions_df
-        
-        # Display previous result if available
-        if st.session_state.last_result:
-            if st.session_state.last_result == "✅ Correct! Moving to the next question.":
-                st.success(st.session_state.last_result)
-            else:
-                st.error(st.session_state.last_result)
-            st.session_state.last_result = None # Clear feedback after display
-
-        st.markdown(f"**Topic:** `{selected_category_name}` | **Difficulty:** `{selected_difficulty_name}`")
-        
-        st.markdown(f"**Question {current_index + 1} of {num_questions}**")
-        st.progress((current_index + 1) / num_questions)
-        st.markdown("---")
-
-
-        current_q = questions_df.iloc[current_index]
-        
-        question_text = current_q['question']
-        options = current_q['options']
-        
-        st.subheader(f"❓ {question_text}")
-        
-        # FIX: Using st.form's onSubmit to prevent double-click issues and calling st.rerun
-        with st.form(key=f'question_form_{current_index}', clear_on_submit=False):
-            user_choice = st.radio(
-                "Select your answer:",
-                options,
-                index=None,
-                key=f'radio_{current_index}'
-            )
-            
-            # Submit button calls check_answer, which updates the state and calls rerun
-            submit_button = st.form_submit_button(
-                label='Submit Answer', 
-                type="secondary",
-                on_click=check_answer # Direct state update and implicitly triggers rerun
-            )
-
+        _render_question(selected_category_name, selected_difficulty_name)
 
     else:
         # --- Quiz Finished Screen (UX UPGRADE) ---
@@ -589,7 +1005,7 @@ def main():
         st.markdown("---")
 
         # --- Score Saving Section ---
-        if st.session_state.score_submitted is False and st.session_state.get('db') is not None:
+        if st.session_state.score_submitted is False and get_db() is not None:
             difficulty_name = selected_difficulty_name
             category_name = selected_category_name
             
@@ -634,8 +1050,8 @@ def main():
             st.button("Review Answers", on_click=toggle_review_mode, help="Check your answers and the correct solutions.", type="secondary", use_container_width=True)
 
         with col_end4:
-             # This button simply forces a refresh of the leaderboard data
-            st.button("Refresh Leaderboard", on_click=lambda: st.rerun(), help="Refresh to see latest scores.", type="secondary", use_container_width=True)
+             # Drops the 30s leaderboard cache; the callback's own rerun then re-queries Firestore
+            st.button("Refresh Leaderboard", on_click=get_leaderboard_data.clear, help="Refresh to see latest scores.", type="secondary", use_container_width=True)
 
 
 if __name__ == "__main__":